@@ -1,7 +1,8 @@
 import streamlit as st
-from sentence_transformers import SentenceTransformer
-from backend import process_query
-import json
+from groq import Groq
+from backend import process_query, load_quantized_encoder, read_document, build_document_index
+import hashlib
+import orjson
 import os
 from dotenv import load_dotenv
 
@@ -100,11 +101,26 @@ if "result" not in st.session_state:
 @st.cache_resource
 def load_embedding_model():
     try:
-        return SentenceTransformer('all-MiniLM-L6-v2')
+        return load_quantized_encoder()
     except Exception as e:
         st.error(f"Failed to load model: {str(e)}")
         st.stop()
 
+@st.cache_resource
+def get_groq_client(api_key):
+    try:
+        return Groq(api_key=api_key)
+    except Exception as e:
+        st.error(f"Failed to initialize Groq client. Check your API key. Details: {str(e)}")
+        st.stop()
+
+# --- Document Indexing ---
+@st.cache_resource(show_spinner=False, max_entries=16)
+def build_index(doc_hash, file_name, _file_bytes, _model):
+    # Keyed on the content hash; the underscored arguments are not hashed by Streamlit.
+    # Shared by all sessions, so only the most recently used documents are kept in memory.
+    return build_document_index(file_name, _file_bytes, _model)
+
 # --- Main Content ---
 st.title("QUERY SPHERE")
 st.markdown("Analyze documents with AI")
@@ -137,6 +153,10 @@ query = st.text_input(
     label_visibility="collapsed"
 )
 
+# --- Model Warm-up ---
+# Loaded on the first render, after the inputs are on screen, so the first click doesn't pay for it
+embedding_model = load_embedding_model()
+
 # --- Process Button ---
 if st.button("Analyze Document", use_container_width=True):
     if not document_input:
@@ -146,13 +166,19 @@ if st.button("Analyze Document", use_container_width=True):
     else:
         with st.spinner("Processing..."):
             try:
-                embedding_model = load_embedding_model()
-                st.session_state.result = process_query(
-                    GROQ_API_KEY,
-                    document_input,
-                    query,
-                    embedding_model
-                )
+                document = read_document(document_input)
+                if not document:
+                    st.session_state.result = {"error": "Could not read the document. Check the file or URL and try again."}
+                else:
+                    file_name, file_bytes = document
+                    doc_hash = hashlib.sha1(file_bytes).hexdigest()
+                    document = build_index(doc_hash, file_name, file_bytes, embedding_model)
+                    st.session_state.result = process_query(
+                        get_groq_client(GROQ_API_KEY),
+                        document,
+                        query,
+                        embedding_model
+                    )
             except Exception as e:
                 st.error(f"Analysis failed: {str(e)}")
 
@@ -184,7 +210,7 @@ if st.session_state.result:
 
         st.download_button(
             label="Download Results",
-            data=json.dumps(result, indent=2),
+            data=orjson.dumps(result, option=orjson.OPT_INDENT_2).decode(),
             file_name="analysis_results.json",
             mime="application/json"
         )
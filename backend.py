@@ -1,67 +1,250 @@
 import fitz  # PyMuPDF
 import faiss
 import numpy as np
-import json
+import orjson
 import io
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import threading
+import hashlib
+import math
+import os
+import re
 import email
 from email.policy import default
 import docx # For .docx files
-from groq import Groq
 import requests
+import diskcache
+import onnxruntime
 from io import BytesIO
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+from rank_bm25 import BM25Okapi
+from numba import njit, prange
+from chunking import WS_RE, merge_small_chunks, extract_page_blocks
+
+def _available_cpus() -> int:
+    # Affinity reflects the cores this container may actually use; cpu_count() reports the host's
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# Hosted environments often export OMP_NUM_THREADS=1; use every available core for encoding and index add/search
+NUM_THREADS = _available_cpus()
+faiss.omp_set_num_threads(NUM_THREADS)
+
+EMBEDDING_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_MODEL_DIR = ".onnx_model"
+ONNX_QUANTIZED_FILE = "model_quantized.onnx"
+EMBEDDING_MAX_LENGTH = 256  # Same truncation as SentenceTransformer('all-MiniLM-L6-v2')
+
+# Chunk embeddings persist across queries and app restarts, keyed by model and chunk text
+EMBED_CACHE_DIR = ".embed_cache"
+EMBED_CACHE_SIZE_LIMIT = 500 * 1024 ** 2
+_embed_cache = diskcache.Cache(EMBED_CACHE_DIR, size_limit=EMBED_CACHE_SIZE_LIMIT, eviction_policy="least-recently-used")
+
+# A run of text up to the next blank line
+_PARAGRAPH_RE = re.compile(r'[^\n](?:.|\n(?!\s*\n))*')
+_TOKEN_RE = re.compile(r'\w+')
+
+# Shared across downloads so repeat fetches from the same host reuse the TLS connection
+_session = requests.Session()
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Shorter PDFs are extracted in-process. Per-page extraction costs ~1.5 ms and dispatching to the
+# warm pool ~2 ms, so parallelism only clearly pays off on a few dozen pages.
+PDF_PARALLEL_MIN_PAGES = 32
+PDF_MAX_WORKERS = 4
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+# Number of chunks retrieved as context for the answer
+TOP_K = 3
+
+# Below this many chunks a brute-force scan over 8-bit codes is cheaper than building an HNSW graph
+HNSW_MIN_CHUNKS = 200
+HNSW_M = 32
+
+# Above this many chunks vectors are PQ-compressed and searched with IVF
+IVFPQ_MIN_CHUNKS = 2000
+PQ_M = 48
+PQ_NBITS = 8
+IVF_NPROBE = 8
+
+# Documents above this many chunks are too slow to embed in full up front; each query instead
+# embeds only its BM25_TOP_N best lexical matches. Their full index, built for queries with no
+# BM25 match, is therefore always IVFPQ.
+BM25_PREFILTER_MIN_CHUNKS = IVFPQ_MIN_CHUNKS
+BM25_TOP_N = 100
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _mean_pool_normalize(token_embeddings, attention_mask, normalize):
+    """Masked mean over the token axis, optionally L2-normalized, one sentence per parallel iteration."""
+    batch, seq_len, dim = token_embeddings.shape
+    out = np.zeros((batch, dim), dtype=np.float32)
+    for b in prange(batch):
+        count = 0
+        for t in range(seq_len):
+            if attention_mask[b, t]:
+                count += 1
+                for d in range(dim):
+                    out[b, d] += token_embeddings[b, t, d]
+        inv_count = 1.0 / max(count, 1)
+        norm_sq = 0.0
+        for d in range(dim):
+            out[b, d] *= inv_count
+            norm_sq += out[b, d] * out[b, d]
+        if normalize:
+            inv_norm = 1.0 / max(np.sqrt(norm_sq), 1e-12)
+            for d in range(dim):
+                out[b, d] *= inv_norm
+    return out
+
+class OnnxSentenceEncoder:
+    """Int8-quantized MiniLM on ONNX Runtime with a SentenceTransformer-style encode()."""
+
+    def __init__(self, model, tokenizer, model_name: str):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.model_name = model_name
+
+    def encode(self, sentences, batch_size: int = 32, show_progress_bar: bool = False,
+               normalize_embeddings: bool = True, convert_to_numpy: bool = True) -> np.ndarray:
+        """Tokenizes, runs the ORT session, mean-pools and L2-normalizes each batch."""
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            features = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True,  # Pad to the longest sentence in this batch only
+                truncation=True,
+                max_length=EMBEDDING_MAX_LENGTH,
+                return_tensors="np"
+            )
+            token_embeddings = np.ascontiguousarray(self.model(**features).last_hidden_state, dtype=np.float32)
+            batches.append(_mean_pool_normalize(token_embeddings, features["attention_mask"], normalize_embeddings))
+        return np.vstack(batches)
+
+def load_quantized_encoder(model_id: str = EMBEDDING_MODEL_ID, save_dir: str = ONNX_MODEL_DIR) -> OnnxSentenceEncoder:
+    """Exports the model to ONNX with dynamic int8 quantization, reusing a previous export if present."""
+    if not os.path.exists(os.path.join(save_dir, ONNX_QUANTIZED_FILE)):
+        model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=save_dir, quantization_config=qconfig)
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(save_dir)
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = NUM_THREADS
+    model = ORTModelForFeatureExtraction.from_pretrained(
+        save_dir, file_name=ONNX_QUANTIZED_FILE, session_options=session_options
+    )
+    tokenizer = AutoTokenizer.from_pretrained(save_dir)
+    encoder = OnnxSentenceEncoder(model, tokenizer, model_id)
+    # Pay the Numba JIT compile and the first ORT run here, during app warm-up, not on the first query
+    encoder.encode(["warm-up"])
+    return encoder
 
 def get_file_from_blob_url(blob_url: str):
     """Downloads file from blob URL and returns file-like object"""
     try:
-        response = requests.get(blob_url)
-        response.raise_for_status()
-        return BytesIO(response.content)
+        with _session.get(blob_url, stream=True) as response:
+            response.raise_for_status()
+            file_bytes = BytesIO()
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                file_bytes.write(chunk)
+        file_bytes.seek(0)
+        return file_bytes
     except Exception as e:
         print(f"ERROR: Failed to download file from blob URL: {e}")
         return None
 
-def extract_text_from_document(file_or_blob_url) -> list[dict] | None:
-    """Extracts text chunks from a file or blob URL (PDF, DOCX, or EML)."""
+def _get_pdf_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the process-wide PDF extraction pool, starting it on first use."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn, not fork: this process already runs Streamlit, ONNX Runtime, OpenMP and Numba threads
+            _pdf_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pdf_pool
+
+def _discard_pdf_pool(pool: concurrent.futures.ProcessPoolExecutor):
+    """Drops a broken pool so the next caller starts a fresh one."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:  # Another thread may already have replaced it
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _map_pdf_pages(page_ranges: list[tuple[bytes, int, int]], workers: int) -> list[list[dict]]:
+    """Extracts page ranges on the shared pool, retrying once on a fresh pool if a worker died."""
+    for attempt in range(2):
+        pool = _get_pdf_pool(workers)
+        try:
+            return list(pool.map(extract_page_blocks, page_ranges))
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker was killed (MuPDF crash, OOM). Retry out of process so a crashing
+            # document still can't take the app down with it.
+            _discard_pdf_pool(pool)
+            if attempt:
+                raise
+
+def _clean_paragraphs(paragraphs):
+    """Yields (index, text) for each non-empty paragraph with its whitespace collapsed."""
+    for para_num, para in enumerate(paragraphs):
+        if para:
+            yield para_num, WS_RE.sub(' ', para).strip()
+
+def read_document(file_or_blob_url) -> tuple[str, bytes] | None:
+    """Reads an uploaded file or blob URL and returns its file name and raw bytes."""
+    # Handle blob URL case
+    if isinstance(file_or_blob_url, str) and file_or_blob_url.startswith(('http://', 'https://')):
+        file_bytes = get_file_from_blob_url(file_or_blob_url)
+        if not file_bytes:
+            return None
+        file_name = file_or_blob_url.split('/')[-1].split('?')[0]  # Remove query params
+        return file_name, file_bytes.getvalue()
+
+    # Handle file upload case
+    return file_or_blob_url.name, file_or_blob_url.getvalue()
+
+def extract_text_from_document(file_name: str, file_bytes: bytes) -> list[dict] | None:
+    """Extracts text chunks from the raw bytes of a PDF, DOCX, or EML file.
+
+    Returns None when the file has no usable text or an unsupported extension; raises on failures.
+    """
     text_chunks = []
     
     try:
-        # Handle blob URL case
-        if isinstance(file_or_blob_url, str) and file_or_blob_url.startswith(('http://', 'https://')):
-            file_bytes = get_file_from_blob_url(file_or_blob_url)
-            if not file_bytes:
-                return None
-            file_name = file_or_blob_url.split('/')[-1].split('?')[0]  # Remove query params
-        else:
-            # Handle file upload case
-            file_name = file_or_blob_url.name
-            file_bytes = BytesIO(file_or_blob_url.getvalue())
-        
         if file_name.lower().endswith('.pdf'):
-            doc = fitz.open(stream=file_bytes, filetype="pdf")
-            for page_num, page in enumerate(doc):
-                blocks = page.get_text("blocks")
-                for block in blocks:
-                    text = block[4].replace('\n', ' ').strip()
-                    if len(text) > 40:
-                        text_chunks.append({
-                            "text": text, 
-                            "page": page_num + 1,
-                            "source": f"PDF page {page_num + 1}"
-                        })
+            with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+                page_count = doc.page_count
+            workers = min(NUM_THREADS, PDF_MAX_WORKERS)
+            if page_count < PDF_PARALLEL_MIN_PAGES or workers == 1:
+                text_chunks.extend(extract_page_blocks((file_bytes, 0, page_count)))
+            else:
+                # One contiguous page range per worker so the PDF bytes are pickled once per process
+                step = math.ceil(page_count / workers)
+                page_ranges = [(file_bytes, start, min(start + step, page_count)) for start in range(0, page_count, step)]
+                for chunks in _map_pdf_pages(page_ranges, workers):
+                    text_chunks.extend(chunks)
         
         elif file_name.lower().endswith('.docx'):
-            doc = docx.Document(file_bytes)
-            for para_num, para in enumerate(doc.paragraphs):
-                text = para.text.strip()
-                if len(text) > 40:
-                    text_chunks.append({
-                        "text": text,
-                        "page": para_num + 1,
-                        "source": f"Section {para_num + 1}"
-                    })
+            doc = docx.Document(BytesIO(file_bytes))
+            text_chunks.extend(
+                {"text": text, "page": para_num + 1, "source": f"Section {para_num + 1}"}
+                for para_num, text in merge_small_chunks(
+                    (n, t) for n, t in _clean_paragraphs(para.text for para in doc.paragraphs) if len(t) > 40
+                )
+            )
 
         elif file_name.lower().endswith('.eml'):
-            msg = email.message_from_bytes(file_bytes.getvalue(), policy=default)
+            msg = email.message_from_bytes(file_bytes, policy=default)
             body = ""
             if msg.is_multipart():
                 for part in msg.walk():
@@ -74,28 +257,103 @@ def extract_text_from_document(file_or_blob_url) -> list[dict] | None:
                 if msg.get_content_type() == 'text/plain':
                     body = msg.get_payload(decode=True).decode()
             
-            for para_num, para in enumerate(body.split('\n\n')):
-                text = para.replace('\n', ' ').strip()
-                if len(text) > 40:
-                    text_chunks.append({
-                        "text": text,
-                        "page": para_num + 1,
-                        "source": f"Paragraph {para_num + 1}"
-                    })
+            paragraphs = (match.group() for match in _PARAGRAPH_RE.finditer(body))
+            text_chunks.extend(
+                {"text": text, "page": para_num + 1, "source": f"Paragraph {para_num + 1}"}
+                for para_num, text in _clean_paragraphs(paragraphs) if len(text) > 40
+            )
 
         return text_chunks if text_chunks else None
 
     except Exception as e:
         print(f"ERROR: Failed to process file {file_name}.\nDetails: {e}")
+        # Raise rather than return None so a cached "no text" result never hides a transient failure
+        raise
+
+def _bm25_tokens(text: str) -> list[str]:
+    # Word characters only, so "document?" and "policy," match "document" and "policy"
+    return _TOKEN_RE.findall(text.lower())
+
+class DocumentIndex:
+    """A document's chunks and retrieval state, built once and shared by every query on that document."""
+
+    def __init__(self, chunks: list[dict], index=None, bm25=None):
+        self.chunks = chunks
+        self.index = index
+        self.bm25 = bm25
+        self._lock = threading.Lock()
+
+    def full_index(self, embedding_model):
+        """Returns a FAISS index over every chunk, building it on first use."""
+        with self._lock:
+            if self.index is None:
+                index = create_faiss_index([chunk['text'] for chunk in self.chunks], embedding_model)
+                if index is None:
+                    # Raise instead of storing None so a transient failure is retried on the next query
+                    raise RuntimeError("Failed to create document embeddings.")
+                self.index = index
+            return self.index
+
+def build_document_index(file_name: str, file_bytes: bytes, embedding_model) -> DocumentIndex | None:
+    """Extracts a document's chunks and builds the per-document retrieval state shared by every query.
+
+    Returns None if the document has no usable text. Documents with more than BM25_PREFILTER_MIN_CHUNKS
+    chunks get a BM25 model and only each query's candidates are embedded; their full FAISS index is
+    built lazily, for queries that share no terms with the document. Documents with at most TOP_K
+    chunks get neither.
+    """
+    document_chunks = extract_text_from_document(file_name, file_bytes)
+    if not document_chunks:
         return None
+    document = DocumentIndex(document_chunks)
+    if len(document_chunks) <= TOP_K:
+        # Every chunk is retrieved anyway, so there is nothing to index
+        return document
+    if len(document_chunks) > BM25_PREFILTER_MIN_CHUNKS:
+        document.bm25 = BM25Okapi([_bm25_tokens(chunk['text']) for chunk in document_chunks])
+        return document
+    document.full_index(embedding_model)
+    return document
 
 def create_faiss_index(text_chunks: list[str], embedding_model):
-    """Creates a FAISS index using a loaded SentenceTransformer model."""
+    """Creates a FAISS inner-product index over L2-normalized embeddings, i.e. cosine similarity."""
     try:
-        embeddings = embedding_model.encode(text_chunks, show_progress_bar=False)
+        model_name = getattr(embedding_model, "model_name", type(embedding_model).__name__)
+        keys = [(model_name, hashlib.sha256(t.encode()).digest()) for t in text_chunks]
+        vectors = [_embed_cache.get(key) for key in keys]
+        miss_idx = [i for i, vector in enumerate(vectors) if vector is None]
+        if miss_idx:
+            # Encode misses in length order so each batch pads to a similar length
+            miss_idx.sort(key=lambda i: len(text_chunks[i]))
+            miss_embeddings = embedding_model.encode(
+                [text_chunks[i] for i in miss_idx], batch_size=64, show_progress_bar=False,
+                normalize_embeddings=True, convert_to_numpy=True
+            )
+            # No-op when encode already returns a C-contiguous float32 array
+            miss_embeddings = np.ascontiguousarray(miss_embeddings, dtype=np.float32)
+            with _embed_cache.transact():
+                for i, vector in zip(miss_idx, miss_embeddings):
+                    _embed_cache.set(keys[i], vector.tobytes())
+                    vectors[i] = vector
+        embeddings = np.vstack([np.frombuffer(vector, dtype=np.float32) for vector in vectors])
         dimension = embeddings.shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        index.add(np.array(embeddings).astype('float32'))
+        if len(text_chunks) > IVFPQ_MIN_CHUNKS and dimension % PQ_M == 0:
+            nlist = int(4 * math.sqrt(len(text_chunks)))
+            quantizer = faiss.IndexFlatIP(dimension)
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+            index.train(embeddings)
+            index.nprobe = IVF_NPROBE
+        elif len(text_chunks) < HNSW_MIN_CHUNKS:
+            # Exhaustive scan over 8-bit codes: a quarter of the bytes of fp32 with near-identical ranking
+            index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            index.train(embeddings)
+        else:
+            # Graph vectors stored as fp16, halving the bytes read per distance evaluation
+            index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = 40
+            index.hnsw.efSearch = 16
+            index.train(embeddings)
+        index.add(embeddings)
         return index
     except Exception as e:
         print(f"ERROR: Failed to create local embeddings.\nDetails: {e}")
@@ -129,30 +387,41 @@ def synthesize_answer_with_groq(client, query: str, retrieved_clauses: list[dict
         print(f"ERROR: Failed to generate answer with Groq/Llama 3.\nDetails: {e}")
         return None
 
-def process_query(api_key: str, file_or_url, query: str, embedding_model) -> dict:
-    """Main processing pipeline to handle a user query against a document."""
-    try:
-        client = Groq(api_key=api_key)
-    except Exception as e:
-        return {"error": f"Failed to initialize Groq client. Check your API key. Details: {e}"}
-
-    document_chunks = extract_text_from_document(file_or_url)
-    if not document_chunks:
+def process_query(client, document: DocumentIndex | None, query: str, embedding_model) -> dict:
+    """Main processing pipeline to handle a user query against a document's prebuilt retrieval state."""
+    if document is None:
         return {"error": "Could not extract text. The file might be empty, image-based, or in an unsupported format."}
-    
-    document_texts = [chunk['text'] for chunk in document_chunks]
 
-    index = create_faiss_index(document_texts, embedding_model)
-    if not index:
-        return {"error": "Failed to create document embeddings."}
+    document_chunks = document.chunks
+    if len(document_chunks) <= TOP_K:
+        # Search would return every chunk, so skip the query encode and the index
+        retrieved_clauses = document_chunks
+    else:
+        candidates, index = document_chunks, None
+        if document.bm25 is not None:
+            scores = document.bm25.get_scores(_bm25_tokens(query))
+            if scores.max() > 0:
+                # Two-stage retrieval: only the best lexical matches are embedded and indexed
+                top = np.argpartition(-scores, BM25_TOP_N)[:BM25_TOP_N]
+                candidates = [document_chunks[i] for i in top]
+                index = create_faiss_index([c['text'] for c in candidates], embedding_model)
+                if not index:
+                    return {"error": "Failed to create document embeddings."}
+            # Otherwise no query term occurs in the document and any top-N would be arbitrary,
+            # so fall through to the full index, built once and kept with the document
 
-    try:
-        query_embedding = embedding_model.encode([query])
-        k = 3
-        distances, indices = index.search(np.array(query_embedding).astype('float32'), k)
-        retrieved_clauses = [document_chunks[i] for i in indices[0]]
-    except Exception as e:
-        return {"error": f"Failed during search. Details: {e}"}
+        if index is None:
+            try:
+                index = document.full_index(embedding_model)
+            except RuntimeError as e:
+                return {"error": str(e)}
+
+        try:
+            query_embedding = embedding_model.encode([query], normalize_embeddings=True, convert_to_numpy=True)
+            distances, indices = index.search(np.ascontiguousarray(query_embedding, dtype=np.float32), TOP_K)
+            retrieved_clauses = [candidates[i] for i in indices[0]]
+        except Exception as e:
+            return {"error": f"Failed during search. Details: {e}"}
 
     synthesized_answer = synthesize_answer_with_groq(client, query, retrieved_clauses)
     
@@ -164,8 +433,8 @@ def process_query(api_key: str, file_or_url, query: str, embedding_model) -> dic
         }
     
     try:
-        return json.loads(synthesized_answer)
-    except json.JSONDecodeError:
+        return orjson.loads(synthesized_answer)
+    except orjson.JSONDecodeError:
         return {
             "explanation": "Invalid JSON response. Showing most relevant clause.",
             "relevant_clause": retrieved_clauses[0]['text'],
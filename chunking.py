@@ -0,0 +1,37 @@
+# Text chunking helpers shared by backend.py and its PDF worker processes.
+# Keep imports to fitz and re: spawned workers import this module, not backend.py.
+import fitz  # PyMuPDF
+import re
+
+WS_RE = re.compile(r'\s+')
+
+# Consecutive short blocks/paragraphs are merged into chunks of up to this many characters
+MERGE_MAX_CHARS = 300
+
+def merge_small_chunks(chunks):
+    """Coalesces consecutive (index, text) pairs into chunks of up to MERGE_MAX_CHARS, keeping the first index."""
+    start, current = None, ""
+    for idx, text in chunks:
+        if current and len(current) + len(text) + 1 > MERGE_MAX_CHARS:
+            yield start, current
+            current = ""
+        if current:
+            current += " " + text
+        else:
+            start, current = idx, text
+    if current:
+        yield start, current
+
+def extract_page_blocks(page_range: tuple[bytes, int, int]) -> list[dict]:
+    """Extracts text chunks from pages [start, stop) of a PDF. Runs in a worker process."""
+    pdf_bytes, start, stop = page_range
+    text_chunks = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_num in range(start, stop):
+            blocks = doc[page_num].get_text("blocks")
+            cleaned = [WS_RE.sub(' ', block[4]).strip() for block in blocks]
+            text_chunks.extend(
+                {"text": text, "page": page_num + 1, "source": f"PDF page {page_num + 1}"}
+                for _, text in merge_small_chunks((i, t) for i, t in enumerate(cleaned) if len(t) > 40)
+            )
+    return text_chunks